@@ -1,14 +1,33 @@
 # -*- coding: utf-8 -*-
 
+import array
+import heapq
+import io
 import itertools
 import json
 import random
 import typing as t
 
+# node cases of the algorithm, as reported in `nodeCase`
+CASE_FINISHED: t.Final = 1  # T_v is finished
+CASE_UNFINISHED: t.Final = 2  # some child subtree is not finished
+CASE_INHABITED: t.Final = 3  # all child subtrees are finished, some inhabited
+
+NodeCase = t.Literal[1, 2, 3]
+
+# bit flags of the progress of T_v; FINISHED is only ever set with EXPLORED
+EXPLORED: t.Final = 1
+FINISHED: t.Final = 2
+# only reported in `nodeFlags`, where it is derived from the robot counts
+INHABITED: t.Final = 4
+
+# names of the bits of `nodeFlags`, from the lowest
+FLAG_NAMES: t.Final = ("EXPLORED", "FINISHED", "INHABITED")
+
 
 class Step(t.TypedDict):
     step: int
-    nodeCase: list[t.Literal[1, 2, 3]]
+    nodeCase: list[NodeCase]
     positionOfRobots: list[int]
     robotsInNode: list[list[int]]
     isExplored: list[bool]
@@ -17,6 +36,15 @@ class Step(t.TypedDict):
     traversed: list[bool]
 
 
+class CompactStep(t.TypedDict):
+    step: int
+    nodeCase: list[NodeCase]
+    positionOfRobots: list[int]
+    robotsInNode: list[list[int]]
+    nodeFlags: list[int]
+    traversed: list[bool]
+
+
 class Graph(t.TypedDict):
     n: int
     edges: list[list[int]]
@@ -28,168 +56,212 @@ class Result(t.TypedDict):
     steps: list[Step]
 
 
+class CompactResult(t.TypedDict):
+    tree: Graph
+    flagNames: list[str]
+    steps: list[CompactStep]
+
+
 def collective_tree_exploration(k: int, tree: list[list[int]], root: int):
     """
     params:
         k: number of robots
         tree: directed graph provided by adjacency list
         r: root of the tree
+    yields:
+        (step, robots, newly_explored, newly_finished, robot_count_in_subtree,
+        newly_traversed, node_case), where newly_explored, newly_finished and
+        newly_traversed are the nodes that became explored, finished or
+        traversed at this step;
+        robot_count_in_subtree is reused and only valid until the next step
     """
 
     n: t.Final[int] = len(tree)
 
-    parents: t.Final[list[int]] = [-1] * n
-
-    # NOTE: edges, leaves, internal_nodes has topological order
-    edges: t.Final[list[tuple[int, int]]] = [
-        (v, u) for v, adj in enumerate(tree) for u in adj
-    ]
-    for v, u in edges:
-        parents[u] = v
+    parents: t.Final[array.array[int]] = array.array("i", [-1]) * n
+    for v, adj in enumerate(tree):
+        for u in adj:
+            parents[u] = v
+    # the root is its own parent, so that case 1 never has to special-case it
+    parents[root] = root
 
     leaves: t.Final[list[int]] = [v for v, adj in enumerate(tree) if not adj]
-    internal_nodes: t.Final[list[int]] = [v for v, adj in enumerate(tree) if adj]
 
     # traversed[v] := whether node v is traversed by any robot
     traversed: t.Final[list[bool]] = [False] * n
     traversed[root] = True
 
     # robots[i] := node at which robot i is located
-    robots: list[int] = [root] * k
+    # every robot is moved at every step, so next_robots needs no reset
+    robots: array.array[int] = array.array("i", [root]) * k
+    next_robots: array.array[int] = array.array("i", [-1]) * k
 
     # robot_count[v] := number of robots at node v
-    robot_count: list[int] = [0] * n
+    robot_count: t.Final[list[int]] = [0] * n
     robot_count[root] = k
 
     # robot_count_in_subtree[v] := number of robots in the subtree T_v
-    robot_count_in_subtree: list[int] = [0] * n
+    # a robot moves along at most one edge per step, so only the lower end of
+    # that edge gains or loses it
+    robot_count_in_subtree: t.Final[list[int]] = [0] * n
     robot_count_in_subtree[root] = k
 
+    # flags[v] := EXPLORED and FINISHED bits of T_v
     # `explored` means every edge of T_u has been traversed by some robot
-    is_explored: list[bool] = [False] * n
-
     # `finished` means it is `explored` and either there are no robots in it,
     # or all robots in it are in u
-    is_finished: list[bool] = [False] * n
+    # `inhabited` means there are robots in it, i.e. robot_count_in_subtree > 0
+    flags: t.Final[bytearray] = bytearray(n)
 
-    # `inhabited` it is explored and either there are no robots in it
-    is_inhabited: list[bool] = [False] * n
+    # unexplored_children[v] := number of children of v whose subtrees are not
+    # explored; T_v is explored once it drops to 0
+    unexplored_children: t.Final[list[int]] = list(map(len, tree))
 
-    # for visualization
-    node_case: list[t.Literal[1, 2, 3]] = [2] * n
+    # unfinished_children[v] := children of v whose subtrees are not finished,
+    # kept in the order of tree[v] and updated as they become finished
+    unfinished_children: t.Final[list[list[int]]] = [adj.copy() for adj in tree]
 
-    yield (
-        0,
-        robots,
-        is_explored.copy(),
-        is_finished.copy(),
-        is_inhabited.copy(),
-        traversed.copy(),
-        node_case,
-    )
+    # node_case[v] := case applied to the robots at node v; it only changes
+    # when v or one of its children becomes finished
+    node_case: list[NodeCase] = [CASE_UNFINISHED] * n
+
+    yield (0, robots.tolist(), [], [], robot_count_in_subtree, [root], node_case.copy())
+
+    # a leaf has no unfinished children
+    for leaf in leaves:
+        node_case[leaf] = CASE_INHABITED
+
+    n_finished = 0
 
     for step in itertools.count(1):
-        next_robots: list[int] = [-1] * k
+        # `explored`, `finished` and `traversed` never revert, so only report
+        # what changed
+        newly_explored: list[int] = []
+        newly_finished: list[int] = []
+        newly_traversed: list[int] = []
+
+        # (v, c) := c robots enter (c > 0) or leave (c < 0) the subtree T_v
+        moves: list[tuple[int, int]] = []
+
+        # explored nodes which may have become finished at this step
+        candidates: list[int] = []
+
+        for v, robots_indices in group_by_value(robots):
+            case = node_case[v]
 
-        for v, robots_indices in convert_to_value_indices_mapping(robots):
             # case 1
-            if is_finished[v]:
+            if case == CASE_FINISHED:
                 for i in robots_indices:
-                    next_robots[i] = root if v == root else parents[v]
+                    next_robots[i] = parents[v]
+                if v != root:
+                    moves.append((v, -len(robots_indices)))
                 continue
 
             # case 2
-            if us := [u for u in tree[v] if not is_finished[u]]:
+            if case == CASE_UNFINISHED:
+                us = unfinished_children[v]
                 # x1 = x2 = ... = x_z = x_{z+1} + 1 = ... = x_j + 1
-                x = [robot_count_in_subtree[u] for u in us]
+                x = list(map(robot_count_in_subtree.__getitem__, us))
                 ixz = x.index(min(x))
-
-                it = iter(robots_indices)
-                for i in range(len(us)):
-                    u = us[(i + ixz) % len(us)]
-                    for _ in range(len(robots_indices) // len(us)):
-                        next_robots[next(it)] = u
+                us = us[ixz:] + us[:ixz]
+
+                # q robots to each child in turn, then one more to the first r
+                q, r = divmod(len(robots_indices), len(us))
+                targets = [u for u in us for _ in range(q)] + us[:r]
+                for i, u in zip(robots_indices, targets):
+                    next_robots[i] = u
+                for j, u in enumerate(us[: len(robots_indices)]):
+                    if not traversed[u]:
                         traversed[u] = True
-                for i in range(len(robots_indices) % len(us)):
-                    u = us[(i + ixz) % len(us)]
-                    next_robots[next(it)] = u
-                    traversed[u] = True
+                        newly_traversed.append(u)
+                    moves.append((u, q + 1 if j < r else q))
 
                 continue
 
             # case 3
-            if all(is_finished[u] for u in tree[v]) and any(
-                is_inhabited[u] for u in tree[v]
-            ):
+            if robot_count_in_subtree[v] > robot_count[v]:
                 for i in robots_indices:
                     next_robots[i] = v
                 continue
 
             raise RuntimeError("unreachable")
 
-        robots = next_robots
-
-        robot_count = [0] * n
-        for v in robots:
-            robot_count[v] += 1
-
-        robot_count_in_subtree = [0] * n
-        for v, u in reversed(edges):
-            robot_count_in_subtree[u] += robot_count[u]
-            robot_count_in_subtree[v] += robot_count_in_subtree[u]
-
-        for leaf in leaves:
-            is_explored[leaf] = is_explored[leaf] or robot_count[leaf] > 0
-            is_finished[leaf] = is_finished[leaf] or is_explored[leaf]
-
-        for v in reversed(internal_nodes):
-            is_explored[v] = is_explored[v] or all(is_explored[u] for u in tree[v])
-            is_finished[v] = is_finished[v] or all(
-                is_explored[u] and robot_count_in_subtree[u] == 0 for u in tree[v]
-            )
-
-        for v in reversed(range(n)):
-            is_inhabited[v] = robot_count_in_subtree[v] > 0
-
-        node_case: list[t.Literal[1, 2, 3]] = [
-            1
-            if is_finished[v]
-            else 2
-            if any(not is_finished[u] for u in tree[v])
-            else 3
-            for v in range(n)
-        ]
+        robots, next_robots = next_robots, robots
+
+        for v, c in moves:
+            robot_count_in_subtree[v] += c
+            robot_count[v] += c
+            robot_count[parents[v]] -= c
+
+            if c < 0:
+                # no robots may be left below the parent
+                candidates.append(parents[v])
+            elif not flags[v] and not tree[v]:
+                # a leaf is explored as soon as a robot reaches it
+                flags[v] = EXPLORED | FINISHED
+                newly_explored.append(v)
+                newly_finished.append(v)
+
+        # T_v is explored when the last of its children is
+        for u in newly_explored:
+            if u != root:
+                v = parents[u]
+                unexplored_children[v] -= 1
+                if not unexplored_children[v]:
+                    flags[v] = EXPLORED
+                    newly_explored.append(v)
+                    candidates.append(v)
+
+        # an explored node is finished once no robots are below it
+        for v in candidates:
+            if flags[v] == EXPLORED and robot_count_in_subtree[v] == robot_count[v]:
+                flags[v] |= FINISHED
+                newly_finished.append(v)
+
+        n_finished += len(newly_finished)
+
+        for u in newly_finished:
+            node_case[u] = CASE_FINISHED
+            if u != root:
+                v = parents[u]
+                unfinished_children[v].remove(u)
+                if not unfinished_children[v] and node_case[v] == CASE_UNFINISHED:
+                    node_case[v] = CASE_INHABITED
 
         yield (
             step,
-            robots,
-            is_explored.copy(),
-            is_finished.copy(),
-            is_inhabited.copy(),
-            traversed.copy(),
-            node_case,
+            robots.tolist(),
+            newly_explored,
+            newly_finished,
+            robot_count_in_subtree,
+            newly_traversed,
+            node_case.copy(),
         )
 
-        if all(is_finished):
+        if n_finished == n:
             break
 
 
-def convert_to_value_indices_mapping(
+def group_by_value(
     sequence: t.Sequence[int],
 ) -> t.Generator[tuple[int, list[int]], None, None]:
     """
-    Return an iterator of (element, indices) pairs for the given sequence.
-    >>> list(convert_to_value_indices_mapping([1, 2, 3, 1, 2, 3]))
+    Return an iterator of (element, indices) pairs for the given sequence,
+    ordered by the first occurrence of each element.
+    >>> list(group_by_value([1, 2, 3, 1, 2, 3]))
     [(1, [0, 3]), (2, [1, 4]), (3, [2, 5])]
-    >>> list(convert_to_value_indices_mapping([3, 3, 2, 2, 1, 1]))
-    [(1, [4, 5]), (2, [2, 3]), (3, [0, 1])
+    >>> list(group_by_value([3, 3, 2, 2, 1, 1]))
+    [(3, [0, 1]), (2, [2, 3]), (1, [4, 5])]
     """
 
-    n: t.Final[int] = len(sequence)
+    groups: dict[int, list[int]] = {}
+    for i, e in enumerate(sequence):
+        if e in groups:
+            groups[e].append(i)
+        else:
+            groups[e] = [i]
 
-    get = sequence.__getitem__
-    for it, grouper in itertools.groupby(sorted(range(n), key=get), key=get):
-        yield it, list(grouper)
+    yield from groups.items()
 
 
 def graph_to_tree(
@@ -199,7 +271,8 @@ def graph_to_tree(
     Return a directed graph like tree and its adjacency list. The tree is
     rooted at the node with the largest degree.
 
-    NOTE: that node labels is ignored.
+    NOTE: that node labels is ignored. Nodes are relabelled in BFS order from
+    the root, so the root is 0 and the children of each node are consecutive.
     >>> graph_to_tree(5, [[4], [3], [3, 4], [1, 2], [0, 2]])
     ([[0, 1], [0, 2], [1, 3], [2, 4]], [[1, 2], [3], [4], [], []])
     """
@@ -252,55 +325,164 @@ def random_tree(n: int, seed: int = 1991) -> list[list[int]]:
 
     graph: list[list[int]] = [[] for _ in range(n)]
 
+    # the smallest leaf is always joined next
+    leaves = [j for j in range(n) if degree[j] == 1]
+    heapq.heapify(leaves)
+
     for i in seq:
-        for j in range(n):
-            if degree[j] == 1:
-                graph[i].append(j)
-                graph[j].append(i)
-                degree[i] -= 1
-                degree[j] -= 1
-                break
-
-    u, v = {i for i in range(n) if degree[i] == 1}
+        j = heapq.heappop(leaves)
+        graph[i].append(j)
+        graph[j].append(i)
+        degree[i] -= 1
+        if degree[i] == 1:
+            heapq.heappush(leaves, i)
+
+    u, v = leaves
     graph[u].append(v)
     graph[v].append(u)
 
     return graph
 
 
-def run(n: int, k: int, seed: int):
+def run_to_stream(
+    fp: t.TextIO, n: int, k: int, seed: int, compact: bool = False
+) -> None:
+    """
+    Write the JSON encoded Result of a simulation to fp, one step at a time,
+    so that only the current step is held in memory.
+    If compact, write a CompactResult instead, where the flags of each node are
+    a single int of the bits named in `flagNames`.
+    >>> default = json.loads(run(40, 5, 3))
+    >>> compact = json.loads(run(40, 5, 3, compact=True))
+    >>> compact["flagNames"]
+    ['EXPLORED', 'FINISHED', 'INHABITED']
+    >>> len(compact["steps"]) == len(default["steps"])
+    True
+    >>> all(
+    ...     c["nodeFlags"]
+    ...     == [
+    ...         e | f << 1 | i << 2
+    ...         for e, f, i in zip(d["isExplored"], d["isFinished"], d["isInhabited"])
+    ...     ]
+    ...     for c, d in zip(compact["steps"], default["steps"])
+    ... )
+    True
+    """
+
     tree_graph = random_tree(n, seed=seed)
     edges, tree = graph_to_tree(n, tree_graph)
 
-    result: Result = {
-        "tree": {"n": n, "edges": edges, "adjacencyList": tree},
-        "steps": [],
-    }
+    graph: Graph = {"n": n, "edges": edges, "adjacencyList": tree}
+    fp.write('{"tree": ')
+    fp.write(json.dumps(graph))
+    if compact:
+        fp.write(', "flagNames": ')
+        fp.write(json.dumps(FLAG_NAMES))
+    fp.write(', "steps": [')
+
+    flags = bytearray(n)
+    traversed = bytearray(n)
 
     for (
         step,
         robots,
-        is_explored,
-        is_finished,
-        is_inhabited,
-        traversed,
+        newly_explored,
+        newly_finished,
+        robot_count_in_subtree,
+        newly_traversed,
         cases,
     ) in collective_tree_exploration(k, tree, 0):
+        for v in newly_explored:
+            flags[v] |= EXPLORED
+        for v in newly_finished:
+            flags[v] |= FINISHED
+        for v in newly_traversed:
+            traversed[v] = True
+
         robots_in_node: list[list[int]] = [[] for _ in range(n)]
         for i, v in enumerate(robots):
             robots_in_node[v].append(i)
 
-        result["steps"].append(
-            {
+        if compact:
+            compact_step: CompactStep = {
                 "step": step,
                 "nodeCase": cases,
                 "positionOfRobots": robots,
                 "robotsInNode": robots_in_node,
-                "isExplored": is_explored,
-                "isFinished": is_finished,
-                "isInhabited": is_inhabited,
-                "traversed": traversed,
+                "nodeFlags": [
+                    f | INHABITED if c else f
+                    for f, c in zip(flags, robot_count_in_subtree)
+                ],
+                "traversed": list(map(bool, traversed)),
             }
-        )
+            encoded = json.dumps(compact_step)
+        else:
+            step_result: Step = {
+                "step": step,
+                "nodeCase": cases,
+                "positionOfRobots": robots,
+                "robotsInNode": robots_in_node,
+                "isExplored": [f & EXPLORED > 0 for f in flags],
+                "isFinished": [f & FINISHED > 0 for f in flags],
+                "isInhabited": [c > 0 for c in robot_count_in_subtree],
+                "traversed": list(map(bool, traversed)),
+            }
+            encoded = json.dumps(step_result)
+        if step > 0:
+            fp.write(", ")
+        fp.write(encoded)
+
+    fp.write("]}")
+
+
+def run(n: int, k: int, seed: int, compact: bool = False) -> str:
+    """
+    Return the JSON encoded Result of a simulation of k robots on a random
+    tree with n nodes.
+    >>> steps = json.loads(run(20, 5, 28))["steps"]
+    >>> len(steps), steps[-1]["positionOfRobots"]
+    (17, [0, 0, 0, 0, 0])
+    >>> all(steps[-1]["isFinished"]), steps[-1]["nodeCase"] == [1] * 20
+    (True, True)
+    >>> steps[0]["isInhabited"][0], steps[-1]["isInhabited"][0]
+    (True, True)
+    """
+
+    fp = io.StringIO()
+    run_to_stream(fp, n, k, seed, compact)
+    return fp.getvalue()
+
+
+def run_batch_to_stream(
+    fp: t.TextIO, n: int, k: int, seeds: t.Iterable[int], compact: bool = False
+) -> None:
+    """
+    Write the JSON encoded list of the Results of run(n, k, seed, compact) for
+    each of the given seeds to fp, so that only the current step of the
+    current simulation is held in memory.
+    NOTE: the simulations run one after another. Every step is per-node
+    Python work, so running them in lockstep would not save any of it.
+    """
+
+    fp.write("[")
+    for i, seed in enumerate(seeds):
+        if i > 0:
+            fp.write(", ")
+        run_to_stream(fp, n, k, seed, compact)
+    fp.write("]")
+
+
+def run_batch(n: int, k: int, seeds: t.Iterable[int], compact: bool = False) -> str:
+    """
+    Return the JSON encoded list of the Results of run(n, k, seed, compact)
+    for each of the given seeds.
+    >>> json.loads(run_batch(10, 3, [1, 2])) == [
+    ...     json.loads(run(10, 3, 1)),
+    ...     json.loads(run(10, 3, 2)),
+    ... ]
+    True
+    """
 
-    return json.dumps(result)
+    fp = io.StringIO()
+    run_batch_to_stream(fp, n, k, seeds, compact)
+    return fp.getvalue()